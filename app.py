@@ -1,35 +1,96 @@
-import base64
 import binascii
+import email.utils
+import http.cookiejar
 import io
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
+import pybase64
 import requests
 from flask import Flask, jsonify, request
 from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
 
 app = Flask(__name__)
 
 ALLOWED_POSITIONS = {"top-right", "top-left", "bottom-right", "bottom-left"}
+ALLOWED_OUTPUT_FORMATS = {"png", "jpeg"}
 
 DEFAULT_LOGO_SCALE = 0.15
 DEFAULT_POSITION = "top-right"
 DEFAULT_PADDING = 20
+DEFAULT_OUTPUT_FORMAT = "png"
 
 LOGO_BG_PADDING = 10
 LOGO_BG_COLOR = (255, 255, 255, 200)  # semi-transparent white
 
+PNG_COMPRESS_LEVEL = 1  # zlib level; 1 encodes several times faster than the default 6
+JPEG_QUALITY = 90
+
 REQUEST_TIMEOUT = (5, 15)
 MAX_LOGO_BYTES = 10 * 1024 * 1024  # 10MB
+MAX_BASE_BYTES = 25 * 1024 * 1024  # 25MB decoded
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+LOGO_CACHE_SIZE = 64
+LOGO_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 64MB
+LOGO_CACHE_TTL = 300  # seconds before revalidating when the host sends no max-age
 
 try:
     RESAMPLE = Image.Resampling.LANCZOS
 except AttributeError:  # Pillow<9.1
     RESAMPLE = Image.LANCZOS
+REDUCING_GAP = 2.0  # see Image.resize(); larger is slower but closer to plain LANCZOS
 
 _DATA_URL_PREFIX_RE = re.compile(r"^data:.*?;base64,", re.IGNORECASE)
-_WHITESPACE_RE = re.compile(r"\s+")
+_WHITESPACE_TABLE = dict.fromkeys(map(ord, " \t\r\n\f\v"), None)
+_EXIF_ORIENTATION = 0x0112
+_FRESHNESS_HEADERS = ("Cache-Control", "Expires", "Date")
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+)
+
+# Shared across requests so repeat logo hosts reuse pooled TCP/TLS connections.
+# Cookies are refused so nothing set during one caller's download is replayed
+# on another's.
+_session = requests.Session()
+_session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+_session.headers["User-Agent"] = "logo-overlay-api/1.0"
+_session.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
+_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
+
+
+def _image_pool_size() -> int:
+    if os.environ.get("IMAGE_WORKERS"):
+        return max(1, int(os.environ["IMAGE_WORKERS"]))
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS/Windows
+        cpus = os.cpu_count() or 1
+    # Every gunicorn worker process builds its own pool, so share the cores.
+    workers = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+    return max(1, cpus // workers)
+
+
+# Bounds CPU-heavy Pillow work to this process's share of the usable cores,
+# regardless of how many request threads the WSGI server runs; Pillow releases
+# the GIL in C. Affinity does not reflect cgroup CPU quotas, so set
+# IMAGE_WORKERS explicitly when running under a container CPU limit.
+_image_pool = ThreadPoolExecutor(max_workers=_image_pool_size(), thread_name_prefix="image")
+
+# url -> (fresh_until, etag, raw bytes, freshness headers). Raw bytes rather than decoded images
+# are cached because each request resizes and mutates its own copy.
+_logo_cache = OrderedDict()
+_logo_cache_bytes = 0
+_logo_cache_lock = threading.Lock()
 
 
 def _error(message: str, status_code: int = 400):
@@ -93,33 +154,78 @@ def _parse_padding(value) -> int:
     return padding
 
 
+def _parse_output_format(value) -> str:
+    if not value:
+        return DEFAULT_OUTPUT_FORMAT
+    output_format = value.lower() if isinstance(value, str) else None
+    if output_format not in ALLOWED_OUTPUT_FORMATS:
+        allowed = ", ".join(sorted(ALLOWED_OUTPUT_FORMATS))
+        raise ValueError(f"output_format must be one of: {allowed}")
+    return output_format
+
+
 def _decode_base64_image(data: str) -> Image.Image:
     if not isinstance(data, str) or not data.strip():
         raise ValueError("base_image must be a non-empty base64 string")
 
     data = data.strip()
-    data = _DATA_URL_PREFIX_RE.sub("", data)
-    data = _WHITESPACE_RE.sub("", data)
+    if data[:5].lower() == "data:":
+        data = _DATA_URL_PREFIX_RE.sub("", data, count=1)
+    # Clean payloads (the common case) skip the multi-MB copy entirely.
+    if any(c in data for c in " \t\r\n\f\v"):
+        data = data.translate(_WHITESPACE_TABLE)
 
     missing_padding = len(data) % 4
     if missing_padding:
         data += "=" * (4 - missing_padding)
 
+    if len(data) // 4 * 3 > MAX_BASE_BYTES:
+        raise ValueError("base_image is too large")
+
+    # Sniff the first 12 bytes so non-image payloads are rejected before the
+    # whole string is decoded.
+    try:
+        head = pybase64.b64decode(data[:16], validate=True)
+    except (binascii.Error, ValueError) as exc:
+        raise ValueError("Invalid base64 in base_image") from exc
+    image_format = _sniff_image_format(head)
+    if image_format is None:
+        raise ValueError("base_image must be a PNG, JPEG, WEBP or GIF image")
+
     try:
-        raw = base64.b64decode(data, validate=True)
+        raw = pybase64.b64decode(data, validate=True)
     except (binascii.Error, ValueError) as exc:
         raise ValueError("Invalid base64 in base_image") from exc
 
     try:
-        image = Image.open(io.BytesIO(raw))
+        # The format is already known, so skip probing every other plugin.
+        # BytesIO(bytes) shares the buffer rather than copying it.
+        image = Image.open(io.BytesIO(raw), formats=[image_format])
         image.load()
     except Exception as exc:
         raise ValueError("base_image is not a valid image") from exc
 
+    return _exif_transpose(image)
+
+
+def _sniff_image_format(head: bytes):
+    for signature, image_format in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def _exif_transpose(image: Image.Image) -> Image.Image:
+    # ImageOps.exif_transpose() returns a full copy even when there is nothing
+    # to rotate, which is always the case for PNG logos.
+    if image.getexif().get(_EXIF_ORIENTATION, 1) not in (2, 3, 4, 5, 6, 7, 8):
+        return image
     return ImageOps.exif_transpose(image)
 
 
-def _download_logo(url: str) -> Image.Image:
+def _download_logo(url: str) -> bytes:
     if not isinstance(url, str) or not url.strip():
         raise ValueError("logo_url must be a non-empty string")
 
@@ -127,9 +233,23 @@ def _download_logo(url: str) -> Image.Image:
     if parsed.scheme not in ("http", "https") or not parsed.netloc:
         raise ValueError("logo_url must be a valid http(s) URL")
 
-    headers = {"User-Agent": "logo-overlay-api/1.0"}
+    cached = _get_cached_logo(url)
+    if cached is not None and time.monotonic() < cached[0]:
+        return cached[2]
+
+    headers = {}
+    if cached is not None and cached[1]:
+        headers["If-None-Match"] = cached[1]
     try:
-        with requests.get(url, stream=True, timeout=REQUEST_TIMEOUT, headers=headers) as resp:
+        with _session.get(url, stream=True, timeout=REQUEST_TIMEOUT, headers=headers) as resp:
+            if resp.status_code == 304:
+                if cached is None:
+                    raise ValueError("Failed to download logo from logo_url")
+                # Headers a 304 omits keep their stored values (RFC 9111 4.3.4).
+                freshness = dict(cached[3])
+                freshness.update(_freshness_headers(resp.headers))
+                _store_cached_logo(url, freshness, resp.headers.get("ETag") or cached[1], cached[2])
+                return cached[2]
             resp.raise_for_status()
 
             content_length = resp.headers.get("Content-Length")
@@ -141,43 +261,129 @@ def _download_logo(url: str) -> Image.Image:
                 if length is not None and length > MAX_LOGO_BYTES:
                     raise ValueError("Logo download is too large")
 
-            chunks = []
-            total = 0
-            for chunk in resp.iter_content(chunk_size=8192):
+            buf = io.BytesIO()
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                 if not chunk:
                     continue
-                total += len(chunk)
-                if total > MAX_LOGO_BYTES:
+                if buf.tell() + len(chunk) > MAX_LOGO_BYTES:
                     raise ValueError("Logo download is too large")
-                chunks.append(chunk)
+                buf.write(chunk)
 
-        raw = b"".join(chunks)
+        # getvalue() hands over the buffer without copying it again.
+        raw = buf.getvalue()
     except requests.RequestException as exc:
         raise ValueError("Failed to download logo from logo_url") from exc
 
+    # Only cache bodies Pillow recognises, so an HTML error page served with a
+    # 200 is not replayed for the lifetime of the entry.
+    if _is_image(raw):
+        _store_cached_logo(url, _freshness_headers(resp.headers), resp.headers.get("ETag"), raw)
+    return raw
+
+
+def _is_image(raw: bytes) -> bool:
     try:
-        logo = Image.open(io.BytesIO(raw))
+        # open() only parses the header; the pixel data is decoded later.
+        with Image.open(io.BytesIO(raw)):
+            return True
+    except Exception:
+        return False
+
+
+def _get_cached_logo(url: str):
+    with _logo_cache_lock:
+        entry = _logo_cache.get(url)
+        if entry is not None:
+            _logo_cache.move_to_end(url)
+        return entry
+
+
+def _freshness_headers(headers) -> dict:
+    return {name: headers[name] for name in _FRESHNESS_HEADERS if name in headers}
+
+
+def _cache_ttl(headers):
+    # Seconds a response may be served without revalidation, or None when the
+    # host forbids storing it. Every API caller shares this cache, so private
+    # responses are treated like no-store.
+    directives = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip().strip('"')
+
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    if "max-age" in directives:
+        try:
+            return max(0, int(directives["max-age"]))
+        except ValueError:
+            pass
+    if "Expires" in headers:
+        # An unparseable Expires means the response is already stale.
+        try:
+            expires = email.utils.parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            return 0
+        try:
+            date = email.utils.parsedate_to_datetime(headers["Date"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            date = time.time()
+        return max(0, expires - date)
+    return LOGO_CACHE_TTL
+
+
+def _store_cached_logo(url: str, freshness: dict, etag, raw: bytes) -> None:
+    global _logo_cache_bytes
+
+    ttl = _cache_ttl(freshness)
+    with _logo_cache_lock:
+        old = _logo_cache.pop(url, None)
+        if old is not None:
+            _logo_cache_bytes -= len(old[2])
+        if ttl is None:
+            return
+        _logo_cache[url] = (time.monotonic() + ttl, etag, raw, freshness)
+        _logo_cache_bytes += len(raw)
+
+        while _logo_cache and (
+            len(_logo_cache) > LOGO_CACHE_SIZE or _logo_cache_bytes > LOGO_CACHE_MAX_BYTES
+        ):
+            _, evicted = _logo_cache.popitem(last=False)
+            _logo_cache_bytes -= len(evicted[2])
+
+
+def _open_logo(raw: bytes, base_size: tuple, logo_scale: float, padding: int) -> Image.Image:
+    try:
+        # Logos may be in any format Pillow reads; only narrow the plugin
+        # search when the signature is one we recognise.
+        logo_format = _sniff_image_format(raw[:12])
+        logo = Image.open(io.BytesIO(raw), formats=[logo_format] if logo_format else None)
+        # Size the draft in stored orientation; EXIF 5-8 swap the axes.
+        rotated = logo.getexif().get(_EXIF_ORIENTATION, 1) in (5, 6, 7, 8)
+        logo_w, logo_h = logo.size[::-1] if rotated else logo.size
+        target = _logo_target_size(logo_w, logo_h, *base_size, logo_scale, padding)
+        target_w, target_h = target[::-1] if rotated else target
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when the logo is much
+        # larger than needed, keeping 2x headroom for the final LANCZOS pass.
+        # No-op for non-JPEG formats.
+        logo.draft("RGB", (2 * target_w, 2 * target_h))
         logo.load()
     except Exception as exc:
         raise ValueError("Downloaded logo is not a valid image") from exc
 
-    return ImageOps.exif_transpose(logo)
+    return _exif_transpose(logo)
 
 
-def _overlay_logo(
-    base: Image.Image,
-    logo: Image.Image,
+def _logo_target_size(
+    logo_w: int,
+    logo_h: int,
+    base_w: int,
+    base_h: int,
     logo_scale: float,
-    position: str,
     padding: int,
-) -> Image.Image:
-    base_rgba = base.convert("RGBA")
-    logo_rgba = logo.convert("RGBA")
-
-    base_w, base_h = base_rgba.size
-    if base_w <= 0 or base_h <= 0:
-        raise ValueError("Base image has invalid dimensions")
-
+) -> tuple:
     max_allowed_w = base_w - (2 * padding)
     max_allowed_h = base_h - (2 * padding)
     if max_allowed_w <= 0:
@@ -188,24 +394,61 @@ def _overlay_logo(
     max_logo_w = max(1, max_allowed_w - (2 * LOGO_BG_PADDING))
     max_logo_h = max(1, max_allowed_h - (2 * LOGO_BG_PADDING))
 
-    target_logo_w = max(1, min(base_w, int(base_w * logo_scale)))
-    scale_factor = target_logo_w / max(1, logo_rgba.width)
-    target_logo_h = max(1, int(logo_rgba.height * scale_factor))
+    # Solve for the final size in one step so the logo is resampled only once.
+    target_w = max(1, min(base_w, int(base_w * logo_scale)))
+    scale_factor = target_w / max(1, logo_w)
+    target_h = max(1, int(logo_h * scale_factor))
+
+    if target_w > max_logo_w or target_h > max_logo_h:
+        shrink = min(max_logo_w / target_w, max_logo_h / target_h)
+        target_w = max(1, int(target_w * shrink))
+        target_h = max(1, int(target_h * shrink))
+
+    return target_w, target_h
 
-    if target_logo_w > max_logo_w or target_logo_h > max_logo_h:
-        shrink = min(max_logo_w / target_logo_w, max_logo_h / target_logo_h)
-        target_logo_w = max(1, int(target_logo_w * shrink))
-        target_logo_h = max(1, int(target_logo_h * shrink))
 
-    if (logo_rgba.width, logo_rgba.height) != (target_logo_w, target_logo_h):
-        logo_rgba = (
-            logo_rgba.convert("RGBa").resize((target_logo_w, target_logo_h), RESAMPLE).convert("RGBA")
-        )
+def _overlay_logo(
+    base: Image.Image,
+    logo: Image.Image,
+    logo_scale: float,
+    position: str,
+    padding: int,
+) -> Image.Image:
+    # RGB bases (most photos) are blended in place; other modes are widened
+    # to RGBA first.
+    canvas = base if base.mode in ("RGB", "RGBA") else base.convert("RGBA")
+    # Fully opaque logos skip alpha handling and are pasted without a mask,
+    # which Pillow does as a straight row copy.
+    opaque = _is_opaque(logo)
+    logo_mode = "RGB" if opaque else "RGBA"
+    # convert() always copies, even to the same mode; the logo is private to
+    # this request and never mutated, so logos already in the right mode are
+    # used as-is.
+    fitted = logo if logo.mode == logo_mode else logo.convert(logo_mode)
+
+    base_w, base_h = canvas.size
+    if base_w <= 0 or base_h <= 0:
+        raise ValueError("Base image has invalid dimensions")
+
+    target_logo_w, target_logo_h = _logo_target_size(
+        fitted.width, fitted.height, base_w, base_h, logo_scale, padding
+    )
 
-    bg_w = logo_rgba.width + (2 * LOGO_BG_PADDING)
-    bg_h = logo_rgba.height + (2 * LOGO_BG_PADDING)
-    overlay = Image.new("RGBA", (bg_w, bg_h), (0, 0, 0, 0))
-    overlay.paste(logo_rgba, (LOGO_BG_PADDING, LOGO_BG_PADDING), mask=logo_rgba)
+    if (fitted.width, fitted.height) != (target_logo_w, target_logo_h):
+        # reducing_gap box-reduces large downscales by an integer factor first,
+        # so LANCZOS only runs over the last ~2x of the reduction.
+        target = (target_logo_w, target_logo_h)
+        if opaque:
+            fitted = fitted.resize(target, RESAMPLE, reducing_gap=REDUCING_GAP)
+        else:
+            fitted = (
+                fitted.convert("RGBa")
+                .resize(target, RESAMPLE, reducing_gap=REDUCING_GAP)
+                .convert("RGBA")
+            )
+
+    bg_w = fitted.width + (2 * LOGO_BG_PADDING)
+    bg_h = fitted.height + (2 * LOGO_BG_PADDING)
 
     if position == "top-left":
         x, y = padding, padding
@@ -221,8 +464,56 @@ def _overlay_logo(
     x = max(0, x)
     y = max(0, y)
 
-    base_rgba.alpha_composite(overlay, dest=(x, y))
-    return base_rgba
+    # The padding around the logo is fully transparent, so the logo is blended
+    # straight onto the base in a single pass.
+    x += LOGO_BG_PADDING
+    y += LOGO_BG_PADDING
+    if opaque:
+        canvas.paste(fitted, (x, y))
+        return canvas
+
+    if canvas.mode == "RGB":
+        # With no destination alpha, "over" reduces to a masked paste, which
+        # Pillow runs as one fused integer blend with no tile copies.
+        canvas.paste(fitted, (x, y), mask=fitted)
+        return canvas
+
+    # Only the destination tile is touched.
+    tile = canvas.crop((x, y, x + fitted.width, y + fitted.height))
+    canvas.paste(Image.alpha_composite(tile, fitted), (x, y))
+    return canvas
+
+
+def _is_opaque(image: Image.Image) -> bool:
+    if "transparency" in image.info:
+        return False
+    if image.mode in ("RGBA", "LA", "PA"):
+        return image.getchannel("A").getextrema()[0] == 255
+    return image.mode not in ("RGBa", "La")
+
+
+def _encode_image(image: Image.Image, output_format: str) -> bytes:
+    buf = io.BytesIO()
+    if output_format == "jpeg":
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(buf, format="JPEG", quality=JPEG_QUALITY)
+    else:
+        image.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+
+def _render(
+    base: Image.Image,
+    logo_raw: bytes,
+    logo_scale: float,
+    position: str,
+    padding: int,
+    output_format: str,
+) -> bytes:
+    logo = _open_logo(logo_raw, base.size, logo_scale, padding)
+    out_img = _overlay_logo(base, logo, logo_scale, position, padding)
+    return _encode_image(out_img, output_format)
 
 
 @app.route("/overlay-logo", methods=["POST", "OPTIONS"], strict_slashes=False)
@@ -245,6 +536,7 @@ def overlay_logo():
         logo_scale = _parse_logo_scale(payload.get("logo_scale"))
         position = payload.get("position", DEFAULT_POSITION) or DEFAULT_POSITION
         padding = _parse_padding(payload.get("padding"))
+        output_format = _parse_output_format(payload.get("output_format"))
     except ValueError as exc:
         return _error(str(exc), 400)
 
@@ -253,13 +545,19 @@ def overlay_logo():
         return _error(f"position must be one of: {allowed}", 400)
 
     try:
-        base_img = _decode_base64_image(base_image_b64)
-        logo_img = _download_logo(logo_url)
-        out_img = _overlay_logo(base_img, logo_img, logo_scale, position, padding)
-
-        buf = io.BytesIO()
-        out_img.save(buf, format="PNG")
-        out_b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+        # Decode the base image while the logo downloads.
+        base_future = _image_pool.submit(_decode_base64_image, base_image_b64)
+        try:
+            logo_raw = _download_logo(logo_url)
+        except ValueError:
+            base_future.result()  # base_image errors are reported first
+            raise
+        base_img = base_future.result()
+
+        out_bytes = _image_pool.submit(
+            _render, base_img, logo_raw, logo_scale, position, padding, output_format
+        ).result()
+        out_b64 = pybase64.b64encode_as_string(out_bytes)
     except ValueError as exc:
         return _error(str(exc), 400)
     except Exception: